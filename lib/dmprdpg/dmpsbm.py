@@ -1,10 +1,12 @@
-from .helpers import generate_adjacency_matrix, get_embedding, generate_group_labels, group_by_label
+from .helpers import generate_probability_matrix, get_embeddings_both, group_by_label
 import numpy as np
 import matplotlib.pyplot as plt
-import statsmodels.api as sm
-import pylab as py
-from scipy.linalg import orthogonal_procrustes
 from scipy.sparse import coo_matrix
+from scipy.stats import norm
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 ## Simulate a DMP-SBM model
 def simulate_dmpsbm(n, B_dict, K=None, T=None, prior_K=None, prior_T=None, seed=None):
@@ -71,11 +73,102 @@ def simulate_dmpsbm(n, B_dict, K=None, T=None, prior_K=None, prior_T=None, seed=
     ## Return output
     return A_dict, z, z_prime
 
+## Compiled kernel for the within-community variances (only available if numba is installed), parallel over all the
+## (block, community) pairs; each community is read once, accumulating the column sums and the total sum of squares
+if njit is not None:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _community_variances_jit(blocks, offsets, sizes, out):
+        num_groups = len(sizes)
+        for idx in prange(blocks.shape[0] * num_groups):
+            b = idx // num_groups
+            g = idx % num_groups
+            start = offsets[g]
+            size = sizes[g]
+            sums = np.zeros(blocks.shape[2])
+            sum_squares = 0.0
+            for i in range(start, start + size):
+                for k in range(blocks.shape[2]):
+                    sums[k] += blocks[b, i, k]
+                    x = np.float64(blocks[b, i, k])
+                    sum_squares += x * x
+            out[b, g] = sum_squares / size - np.sum((sums / size) ** 2)
+else:
+    _community_variances_jit = None
+
+## Compiled kernels for the community centroids, parallel over all the (block, community) pairs: a specialised version for
+## the common case d = 4 (the column sums are unrolled into scalar accumulators) and a generic version for any d
+if njit is not None:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _community_centroids_d4_jit(blocks, offsets, sizes, out):
+        num_groups = len(sizes)
+        for idx in prange(blocks.shape[0] * num_groups):
+            b = idx // num_groups
+            g = idx % num_groups
+            s0 = 0.0
+            s1 = 0.0
+            s2 = 0.0
+            s3 = 0.0
+            for i in range(offsets[g], offsets[g] + sizes[g]):
+                s0 += blocks[b, i, 0]
+                s1 += blocks[b, i, 1]
+                s2 += blocks[b, i, 2]
+                s3 += blocks[b, i, 3]
+            out[b, g, 0] = s0 / sizes[g]
+            out[b, g, 1] = s1 / sizes[g]
+            out[b, g, 2] = s2 / sizes[g]
+            out[b, g, 3] = s3 / sizes[g]
+
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _community_centroids_jit(blocks, offsets, sizes, out):
+        num_groups = len(sizes)
+        for idx in prange(blocks.shape[0] * num_groups):
+            b = idx // num_groups
+            g = idx % num_groups
+            sums = np.zeros(blocks.shape[2])
+            for i in range(offsets[g], offsets[g] + sizes[g]):
+                for k in range(blocks.shape[2]):
+                    sums[k] += blocks[b, i, k]
+            out[b, g, :] = sums / sizes[g]
+else:
+    _community_centroids_d4_jit = None
+    _community_centroids_jit = None
+
+## Community centroids of stacked (blocks, n, d) embeddings (rows sorted by community), as a (blocks, groups, d) float64 array
+def _community_centroids(blocks, offsets, sizes):
+    if _community_centroids_jit is not None:
+        out = np.empty((blocks.shape[0], len(sizes), blocks.shape[2]))
+        kernel = _community_centroids_d4_jit if blocks.shape[2] == 4 else _community_centroids_jit
+        kernel(np.ascontiguousarray(blocks), offsets, sizes, out)
+        return out
+    return np.add.reduceat(blocks, offsets, axis=1, dtype=np.float64) / sizes[None, :, None]
+
+## Within-community variances of stacked (blocks, n, d) embeddings (rows sorted by community), summed over the embedding dimensions
+def _community_variances(blocks, offsets, sizes):
+    if _community_variances_jit is not None:
+        out = np.empty((blocks.shape[0], len(sizes)))
+        _community_variances_jit(np.ascontiguousarray(blocks), offsets, sizes, out)
+        return out
+    # Variances from the first two moments, E[x^2] - E[x]^2, each obtained with a single reduceat over all the blocks (squared and accumulated in float64)
+    means = np.add.reduceat(blocks, offsets, axis=1, dtype=np.float64) / sizes[None, :, None]
+    return (np.add.reduceat(np.square(blocks, dtype=np.float64), offsets, axis=1) / sizes[None, :, None] - means ** 2).sum(axis=2)
+
+## Orthogonal Procrustes rotation U V^T from the SVD of the cross-covariance matrix M = A^T B; if proper=True, the sign of the
+## last singular direction is flipped when needed, so that the result is a rotation (determinant 1) rather than a reflection
+def _procrustes_rotation(M, proper=False):
+    U, _, Vt = np.linalg.svd(M, full_matrices=False)
+    R = U @ Vt
+    if proper and np.linalg.det(R) < 0:
+        Vt[-1] *= -1
+        R = U @ Vt
+    return R
+
 ## Full class for simulation
 class dmpsbm:
 
-    # Initialize the model with the number of layers, timesteps, groups, and the dictionary of probabilities
-    def __init__(self, layers, timesteps, groups, prob_dict):
+    # Initialize the model with the number of layers, timesteps, groups, and the dictionary of probabilities; dtype is the precision
+    # of the sampled adjacency matrices and embeddings (centroids, variances, rotations and errors are always computed in float64,
+    # and the Bernoulli draws do not depend on dtype, so the same seed gives the same graphs in both precisions)
+    def __init__(self, layers, timesteps, groups, prob_dict, dtype=np.float32):
         # Store the model parameters (after checking that they are valid)
         if not isinstance(layers, int) or layers <= 0:
             raise ValueError("The number of layers must be a positive integer")
@@ -83,162 +176,194 @@ class dmpsbm:
         if not isinstance(timesteps, int) or timesteps <= 0:
             raise ValueError("The number of timesteps must be a positive integer")
         self.timesteps = timesteps
-        if not isinstance(groups, list) or len(groups) == 0 or not all(isinstance(x, int) for x in groups):
-            raise ValueError("The groups must be a non-empty list of integers")
+        if not isinstance(groups, list) or len(groups) == 0 or not all(isinstance(x, int) and x > 0 for x in groups):
+            raise ValueError("The groups must be a non-empty list of positive integers")
         self.groups = groups
         if not isinstance(prob_dict, dict) or not all(isinstance(key, tuple) and len(key) == 2 and isinstance(value, list) for key, value in prob_dict.items()):
             raise ValueError("The probability dictionary must be a dictionary with keys as tuples and values as lists")
         self.prob_dict = prob_dict
+        if np.dtype(dtype) not in (np.float32, np.float64):
+            raise ValueError("The dtype must be float32 or float64")
+        self.dtype = np.dtype(dtype)
+        # Cache the community sizes and counts, and the labels (integer ids) and starting rows within a layer (or time) block of the embeddings
+        self._sizes = np.asarray(self.groups)
+        self._num_groups = len(self.groups)
+        self._num_nodes = int(self._sizes.sum())
+        self._labels = np.repeat(np.arange(self._num_groups), self._sizes)
+        self._offsets = np.r_[0, np.cumsum(self._sizes)[:-1]]
+        # Unfolded (layers*groups, timesteps*groups) matrix of block probabilities, and its node-level
+        # (layers, timesteps, n, n) expansion (built on the first call to sample); both are rebuilt if prob_dict is modified
+        self._B = self._unfold_prob_dict()
+        self._P = None
         # Initialize other model attributes to None
         self.A = None
+        self.A4 = None
         self.left_embedding = None
         self.right_embedding = None
         self.left_centroids = None
         self.right_centroids = None
+        self.left_centroids_flat = None
+        self.right_centroids_flat = None
         self.left_embedding_theo = None
         self.right_embedding_theo = None
         self.rotation_left = None
         self.rotation_right = None
         self.error = 0
 
+    # Check that each block probability matrix is a symmetric (groups x groups) matrix with entries in [0, 1], and unfold them
+    # into a (layers*groups, timesteps*groups) matrix
+    def _unfold_prob_dict(self):
+        for key in [(i, j) for i in range(self.layers) for j in range(self.timesteps)]:
+            if key not in self.prob_dict:
+                raise ValueError("The probability dictionary must contain all (layer, time) pairs")
+            block = np.asarray(self.prob_dict[key], dtype=np.float64)
+            if block.shape != (self._num_groups, self._num_groups):
+                raise ValueError("Each probability matrix must be square with one row and column per group")
+            if not np.allclose(block, block.T):
+                raise ValueError("Each probability matrix must be symmetric")
+            if np.any(block < 0) or np.any(block > 1):
+                raise ValueError("The probabilities must be between 0 and 1")
+        return np.block([[np.asarray(self.prob_dict[(i, j)], dtype=np.float64) for j in range(self.timesteps)] for i in range(self.layers)])
+
+    # Rebuild the cached block probabilities (and drop their node-level expansion) if prob_dict has been modified
+    def _refresh_probabilities(self):
+        B = self._unfold_prob_dict()
+        if not np.array_equal(B, self._B):
+            self._B = B
+            self._P = None
+
     # Sample the adjacency matrices and calculate the embeddings
-    def sample(self):
-        list_longs = []
-        for i in range(self.layers):
-            curr_long = []
-            for j in range(self.timesteps):
-                curr_A = generate_adjacency_matrix(len_groups=self.groups, probabilities=self.prob_dict[(i, j)])
-                curr_long.append(curr_A)
-            final_long = np.concatenate(curr_long, axis=1)
-            list_longs.append(final_long)
-        final_embedding = np.concatenate(list_longs, axis=0)
-        self.A = final_embedding
-        left_embedding = get_embedding(final_embedding, type='left')
-        self.left_embedding = left_embedding
-        right_embedding = get_embedding(final_embedding, type='right')
-        self.right_embedding = right_embedding
-
-    # Calculate the theoretical embeddings and rotate them to match the sampled embeddings
-    def get_centroids_theo(self):
-        list_longs = []
-        for i in range(self.layers):
-            curr_long = []
-            for j in range(self.timesteps):
-                curr_B = self.prob_dict[(i, j)]
-                curr_long.append(curr_B)
-            final_long = np.concatenate(curr_long, axis=1)
-            list_longs.append(final_long)
-        final_embedding = np.concatenate(list_longs, axis=0)
-        self.left_embedding_theo = get_embedding(final_embedding, type='left')
-        self.right_embedding_theo = get_embedding(final_embedding, type='right')
-        self.rotate()
-
-    # Calculate the rotation matrices to align the theoretical embeddings with the sampled embeddings
-    def get_rotation(self):
-        left_stacked = np.concatenate(self.left_centroids, axis = 0)
-        rotation = orthogonal_procrustes(self.left_embedding_theo, left_stacked)[0]
-        self.rotation_left = rotation
-        right_stacked = np.concatenate(self.right_centroids, axis=0)
-        rotation = orthogonal_procrustes(self.right_embedding_theo, right_stacked)[0]
-        self.rotation_right = rotation
+    def sample(self, seed=None):
+        self._refresh_probabilities()
+        # Preallocate the unfolded (layers*n, timesteps*n) matrix; A4[i, j] is a view of the (layer i, time j) block
+        self.A = np.empty((self.layers * self._num_nodes, self.timesteps * self._num_nodes), dtype=self.dtype)
+        self.A4 = self.A.reshape(self.layers, self._num_nodes, self.timesteps, self._num_nodes).transpose(0, 2, 1, 3)
+        # Expand the block probabilities to node level (once) and draw all the Bernoulli variables at once
+        if self._P is None:
+            B4 = self._B.reshape(self.layers, self._num_groups, self.timesteps, self._num_groups).transpose(0, 2, 1, 3)
+            self._P = generate_probability_matrix(len_groups=self.groups, probabilities=B4)
+        rng = np.random.default_rng(seed)
+        # Undirected graphs without self-loops: sample the strict upper triangle and mirror it (drawn in float64 whatever the dtype)
+        upper = np.triu(rng.random(self._P.shape) < self._P, 1)
+        self.A4[...] = upper
+        self.A4 += upper.transpose(0, 1, 3, 2)
+        self.left_embedding, self.right_embedding = get_embeddings_both(self.A)
+
+    # Calculate the theoretical embeddings and rotate them to match the sampled embeddings (reflections are allowed unless proper=True)
+    def get_centroids_theo(self, proper=False):
+        self._refresh_probabilities()
+        self.left_embedding_theo, self.right_embedding_theo = get_embeddings_both(self._B)
+        self.rotate(proper=proper)
+
+    # Calculate the rotation matrices to align the theoretical embeddings with the sampled embeddings (proper rotations only if proper=True)
+    def get_rotation(self, proper=False):
+        # Solve the Procrustes problems from the d x d cross-covariance matrices A^T B
+        self.rotation_left = _procrustes_rotation(self.left_embedding_theo.T @ self.left_centroids_flat, proper=proper)
+        self.rotation_right = _procrustes_rotation(self.right_embedding_theo.T @ self.right_centroids_flat, proper=proper)
 
     # Rotate the theoretical embeddings to match the sampled embeddings
-    def rotate(self):
-        self.get_rotation()
+    def rotate(self, proper=False):
+        self.get_rotation(proper=proper)
         self.left_embedding_theo = self.left_embedding_theo @ self.rotation_left
         self.right_embedding_theo = self.right_embedding_theo @ self.rotation_right
         self.calculate_error()
         print("Total Error: ", self.error)
 
-    # Calculate the error between the sampled and theoretical embeddings
+    # Calculate the error between the sampled and theoretical embeddings, using ||A - B||^2 = ||A||^2 + ||B||^2 - 2 <A, B>
+    # (no difference matrix is formed)
     def calculate_error(self):
-        left_stacked = np.concatenate(self.left_centroids, axis=0)
-        right_stacked = np.concatenate(self.right_centroids, axis=0)
-        self.error = sum(sum((self.left_embedding_theo - left_stacked)**2)) + sum(sum((self.right_embedding_theo - right_stacked)**2))
-        self.calculate_variance()
+        left_theo = self.left_embedding_theo
+        right_theo = self.right_embedding_theo
+        left_stacked = self.left_centroids_flat
+        right_stacked = self.right_centroids_flat
+        left_error = np.einsum('ij,ij->', left_theo, left_theo) + np.einsum('ij,ij->', left_stacked, left_stacked) - 2 * np.einsum('ij,ij->', left_theo, left_stacked)
+        right_error = np.einsum('ij,ij->', right_theo, right_theo) + np.einsum('ij,ij->', right_stacked, right_stacked) - 2 * np.einsum('ij,ij->', right_theo, right_stacked)
+        self.error = left_error + right_error
+
+    # Views of the embeddings as (layers, n, d) and (timesteps, n, d) arrays
+    @property
+    def left_embedding_3d(self):
+        return self.left_embedding.reshape(self.layers, self._num_nodes, -1)
+
+    @property
+    def right_embedding_3d(self):
+        return self.right_embedding.reshape(self.timesteps, self._num_nodes, -1)
 
-    # Calculate the variance of the embeddings within each community
+    # Calculate the variance of the embeddings within each community, as (layers, groups) and (timesteps, groups) arrays
     def calculate_variance(self):
-        num_nodes = sum(self.groups)
+        left_variances = _community_variances(self.left_embedding_3d, self._offsets, self._sizes)
+        right_variances = _community_variances(self.right_embedding_3d, self._offsets, self._sizes)
+        return left_variances, right_variances
+
+    # Plot the variance of the embeddings within each community
+    def plot_variances(self):
+        left_variances, right_variances = self.calculate_variance()
         for layer in range(self.layers):
-            current_layer = self.left_embedding[num_nodes*layer:num_nodes*(layer+1), :]
-            start = 0
-            variances = []
-            for size in self.groups:
-                variances.append(sum(np.var(current_layer[start:start + size, :], axis=0)))
-                start += size
-            plt.bar(x = range(len(self.groups)), height = variances, color = 'darkblue')
+            plt.bar(x = range(self._num_groups), height = left_variances[layer], color = 'darkblue')
             plt.title("Community Variances Layer " + str(layer+1))
             plt.show()
         for time in range(self.timesteps):
-            current_time = self.right_embedding[num_nodes*time:num_nodes*(time+1), :]
-            start = 0
-            variances = []
-            for size in self.groups:
-                variances.append(sum(np.var(current_time[start:start + size, :], axis=0)))
-                start += size
-            plt.bar(x = range(len(self.groups)), height = variances, color = 'darkblue')
+            plt.bar(x = range(self._num_groups), height = right_variances[time], color = 'darkblue')
             plt.title("Community Variances Time " + str(time+1))
             plt.show()
 
-    # Calculate the centroids of the communities in the embeddings
+    # Calculate the centroids of the communities in the embeddings as (layers, groups, d) and (timesteps, groups, d) arrays, with
+    # contiguous (layers*groups, d) and (timesteps*groups, d) views of the stacked centroids
     def get_centroids(self):
-        left_centroids = []
-        right_centroids = []
-        total_nodes = sum(self.groups)
-        for layer in range(self.layers):
-            current_layer = self.left_embedding[total_nodes*layer:total_nodes*(layer+1), :]
-            current_embeddings = []
-            for label in set(generate_group_labels(len_groups=self.groups)):
-                labels = np.array(generate_group_labels(len_groups=self.groups))
-                community = current_layer[labels == label]
-                current_embeddings.append([np.mean(community[:, 0]), np.mean(community[:, 1]), np.mean(community[:, 2]), np.mean(community[:, 3])])
-            left_centroids.append(current_embeddings)
-        self.left_centroids = left_centroids
-        for time in range(self.timesteps):
-            current_time = self.right_embedding[total_nodes*time:total_nodes*(time+1), :]
-            current_embeddings = []
-            for label in set(generate_group_labels(len_groups=self.groups)):
-                labels = np.array(generate_group_labels(len_groups=self.groups))
-                community = current_time[labels == label]
-                current_embeddings.append([np.mean(community[:, 0]), np.mean(community[:, 1]), np.mean(community[:, 2]), np.mean(community[:, 3])])
-            right_centroids.append(current_embeddings)
-        self.right_centroids = right_centroids
-
-    # Plot the embeddings and centroids
+        self.left_centroids = _community_centroids(self.left_embedding_3d, self._offsets, self._sizes)
+        self.left_centroids_flat = self.left_centroids.reshape(self.layers * self._num_groups, -1)
+        self.right_centroids = _community_centroids(self.right_embedding_3d, self._offsets, self._sizes)
+        self.right_centroids_flat = self.right_centroids.reshape(self.timesteps * self._num_groups, -1)
+
+    # Plot the embeddings and centroids (one figure for the layers and one for the time steps)
     def plot(self):
-        total_nodes  = sum(self.groups)
-        num_groups = len(self.groups)
-        for layer in range(self.layers):
-            fig, ax = plt.subplots()
+        left_embedding_3d = self.left_embedding_3d
+        left_theo = self.left_embedding_theo.reshape(self.layers, self._num_groups, -1)
+        fig, axes = plt.subplots(1, self.layers, figsize=(5 * self.layers, 5), squeeze=False)
+        for layer, ax in enumerate(axes[0]):
             ax.grid()
-            ax.scatter(x=self.left_embedding[total_nodes*layer:total_nodes*(layer+1), 0], y=self.left_embedding[total_nodes*layer:total_nodes*(layer+1), 1], c=generate_group_labels(len_groups=self.groups))
-            ax.scatter(x=self.left_embedding_theo[num_groups * layer:num_groups * (layer + 1), 0], y=self.left_embedding_theo[num_groups * layer:num_groups * (layer + 1), 1], c='orange', marker='x', s=80)
-            for point in self.left_centroids[layer]:
-                ax.scatter(point[0], point[1], c='red')
-            plt.title("Left Embedding Layer " + str(layer+1))
-            plt.show()
-        for time in range(self.timesteps):
-            fig, ax = plt.subplots()
+            ax.scatter(x=left_embedding_3d[layer, :, 0], y=left_embedding_3d[layer, :, 1], c=self._labels)
+            ax.scatter(x=left_theo[layer, :, 0], y=left_theo[layer, :, 1], c='orange', marker='x', s=80)
+            ax.scatter(x=self.left_centroids[layer, :, 0], y=self.left_centroids[layer, :, 1], c='red')
+            ax.set_title("Left Embedding Layer " + str(layer+1))
+        plt.show()
+        right_embedding_3d = self.right_embedding_3d
+        right_theo = self.right_embedding_theo.reshape(self.timesteps, self._num_groups, -1)
+        fig, axes = plt.subplots(1, self.timesteps, figsize=(5 * self.timesteps, 5), squeeze=False)
+        for time, ax in enumerate(axes[0]):
             ax.grid()
-            ax.scatter(x=self.right_embedding[total_nodes*time:total_nodes*(time+1), 0], y=self.right_embedding[total_nodes*time:total_nodes*(time+1), 1], c=generate_group_labels(len_groups=self.groups))
-            ax.scatter(x=self.right_embedding_theo[num_groups * time:num_groups * (time + 1), 0], y=self.right_embedding_theo[num_groups * time:num_groups * (time + 1), 1], c='orange', marker='x', s=80)
-            for point in self.right_centroids[time]:
-                ax.scatter(point[0], point[1], c='red')
-            plt.title("Right Embedding Time " + str(time+1))
-            plt.show()
+            ax.scatter(x=right_embedding_3d[time, :, 0], y=right_embedding_3d[time, :, 1], c=self._labels)
+            ax.scatter(x=right_theo[time, :, 0], y=right_theo[time, :, 1], c='orange', marker='x', s=80)
+            ax.scatter(x=self.right_centroids[time, :, 0], y=self.right_centroids[time, :, 1], c='red')
+            ax.set_title("Right Embedding Time " + str(time+1))
+        plt.show()
+
+    # Calculate the QQ plot coordinates for the left embeddings: qq[layer][group] is a pair (theoretical quantiles, standardised sorted community)
+    def calculate_qq(self):
+        # Normal quantiles at the plotting positions i/(n+1), computed once per community size
+        theo_quantiles = {size: norm.ppf(np.arange(1, size + 1) / (size + 1)) for size in set(self.groups)}
+        qq = []
+        for current_layer in self.left_embedding_3d:
+            qq_layer = []
+            for start, size in zip(self._offsets, self._sizes):
+                # Sorted and standardised community (equivalent to fitting a normal distribution to each dimension)
+                community = np.sort(current_layer[start:start + size, :], axis=0)
+                community = (community - np.mean(community, axis=0)) / np.std(community, axis=0)
+                qq_layer.append((theo_quantiles[size], community))
+            qq.append(qq_layer)
+        return qq
 
-    # Generate a QQ plot for the embeddings (marginally for each dimension)
+    # Generate a QQ plot for the embeddings (marginally for each dimension, one figure per layer)
     def qq_plot(self):
-        num_nodes = sum(self.groups)
-        for layer in range(self.layers):
-            current_layer = self.left_embedding[num_nodes * layer:num_nodes * (layer + 1), :]
-            start = 0
-            for size in self.groups:
-                community = current_layer[start:start + size, :]
-                mean = np.mean(community, axis=0)
-                community = community - mean
-                for dimension in range(4):
-                    sm.qqplot(community[:, dimension], fit=True, line=45)
-                    py.show()
-                start += size
\ No newline at end of file
+        dimensions = self.left_embedding.shape[1]
+        for layer, qq_layer in enumerate(self.calculate_qq()):
+            fig, axes = plt.subplots(dimensions, self._num_groups, figsize=(3 * self._num_groups, 3 * dimensions), squeeze=False)
+            for group, (theoretical, community) in enumerate(qq_layer):
+                for dimension in range(dimensions):
+                    ax = axes[dimension, group]
+                    ax.scatter(theoretical, community[:, dimension], s=10)
+                    ax.axline((0, 0), slope=1, c='red')
+                    ax.set_title("Community " + str(group+1) + ", Dimension " + str(dimension+1))
+            fig.suptitle("QQ Plots Layer " + str(layer+1))
+            fig.tight_layout()
+            plt.show()
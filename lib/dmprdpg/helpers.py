@@ -2,6 +2,7 @@ from itertools import accumulate
 from networkx import stochastic_block_model, adjacency_matrix
 import random
 import numpy as np
+from scipy.sparse.linalg import svds
 import pandas as pd
 
 def generate_groups(num_nodes, len_groups, randomize = False):
@@ -25,17 +26,29 @@ def generate_adjacency_matrix(len_groups, probabilities):
     matrix = adjacency_matrix(model)
     return matrix.toarray()
 
+def generate_probability_matrix(len_groups, probabilities):
+    # Expands the last two axes, so stacks of block matrices are also supported
+    blocks = np.asarray(probabilities, dtype=np.float64)
+    return np.repeat(np.repeat(blocks, len_groups, axis=-2), len_groups, axis=-1)
+
+def get_embeddings_both(A, dimension = 4):
+    # ARPACK cannot start from an all-zero matrix (e.g. a sampled graph without edges), so the dense SVD is used there
+    if dimension < min(A.shape) and A.any():
+        # Truncated SVD: only the top singular triplets are computed (returned in ascending order)
+        U, D, Vh = svds(A, k = dimension)
+        U, D, Vh = U[:,::-1], D[::-1], Vh[::-1,:]
+    else:
+        U, D, Vh = np.linalg.svd(A, full_matrices = False)
+    D_half = np.sqrt(D[0:dimension])
+    left_embedding = U[:,0:dimension] * D_half
+    right_embedding = np.transpose(Vh[0:dimension,:]) * D_half
+    return left_embedding, right_embedding
+
 def get_embedding(A, dimension = 4, type = 'left'):
-    decomp = np.linalg.svd(A, full_matrices = False)
-    U = decomp.U
-    D = decomp.S
-    D_half = np.diag(np.sqrt(D))
-    V = np.transpose(decomp.Vh)
+    left_embedding, right_embedding = get_embeddings_both(A, dimension = dimension)
     if type == 'right':
-        right_embedding = V @ D_half
-        return right_embedding[:,0:dimension]
-    left_embedding = U @ D_half
-    return left_embedding[:,0:dimension]
+        return right_embedding
+    return left_embedding
 
 def group_by_label(matrix, labels):
     labels = np.array(labels)
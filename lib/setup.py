@@ -10,7 +10,6 @@ setup(
 		"numpy",
 		"scipy",
         "networkx",
-        "statsmodels",
         "matplotlib"
 	],
 )
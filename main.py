@@ -23,6 +23,8 @@ if __name__ == '__main__':
     # Calculate the centroids of the sampled embeddings
     model.get_centroids()
     model.get_centroids_theo()
+    # Plot the within-community variances of the sampled embeddings
+    model.plot_variances()
     # model.qq_plot()
     model.plot()
     # Pre-define a different matrix B - Index is (layer, time)
@@ -37,4 +39,5 @@ if __name__ == '__main__':
     model2.sample()
     model2.get_centroids()
     model2.get_centroids_theo()
+    model2.plot_variances()
     model2.plot()